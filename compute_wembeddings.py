@@ -7,7 +7,9 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import re
+import concurrent.futures
+import io
+import queue
 import sys
 import zipfile
 
@@ -23,9 +25,10 @@ if __name__ == "__main__":
     parser.add_argument("input_path", type=str, help="Input file")
     parser.add_argument("output_npz", type=str, help="Output NPZ file")
     parser.add_argument("--batch_size", default=64, type=int, help="Batch size")
-    parser.add_argument("--dtype", default="float16", type=str, help="Dtype to save as")
+    parser.add_argument("--dtype", default="float16", type=str, help="Dtype to save as (int8 stores also per-word scales)")
     parser.add_argument("--format", default="conllu", type=str, help="Input format (conllu, conll)")
     parser.add_argument("--model", default="bert-base-multilingual-uncased-last4", type=str, help="Model name (see wembeddings.py for options)")
+    parser.add_argument("--runtime", default="tf", type=str, help="Runtime to use (tf, onnx)")
     parser.add_argument("--server", default=None, type=str, help="Use given server to compute the embeddings")
     parser.add_argument("--threads", default=4, type=int, help="Threads to use")
     args = parser.parse_args()
@@ -35,22 +38,23 @@ if __name__ == "__main__":
 
     # Load the input file
     sentences = []
-    with open(args.input_path, mode="r", encoding="utf-8") as input_file:
+    # The file is processed as bytes, and only the forms are decoded
+    with open(args.input_path, mode="rb") as input_file:
         in_sentence = False
         for line in input_file:
-            line = line.rstrip("\n")
+            line = line.rstrip(b"\r\n")
             if line:
                 if not in_sentence:
                     sentences.append([])
                     in_sentence = True
 
-                columns = line.split("\t")
                 if args.format == "conll":
-                    sentences[-1].append(columns[0])
+                    sentences[-1].append(line.split(b"\t", 1)[0].decode("utf-8"))
                 elif args.format == "conllu":
+                    columns = line.split(b"\t", 2)
                     if columns[0].isdigit():
-                        assert len(columns) == 10
-                        sentences[-1].append(columns[1])
+                        assert line.count(b"\t") == 9
+                        sentences[-1].append(columns[1].decode("utf-8"))
             else:
                 in_sentence = False
     print("Loaded {} sentences and {} words.".format(len(sentences), sum(map(len, sentences))), file=sys.stderr, flush=True)
@@ -58,16 +62,58 @@ if __name__ == "__main__":
     # Initialize suitable computational class
     if args.server is not None:
         wembeddings = wembeddings.WEmbeddings.ClientNetwork(args.server)
+        prepare_batch = lambda batch: batch
+        compute_embeddings = lambda batch: wembeddings.compute_embeddings(args.model, batch)
     else:
-        wembeddings = wembeddings.WEmbeddings(threads=args.threads)
+        wembeddings = wembeddings.WEmbeddings(threads=args.threads, dtype=np.float32 if args.dtype == np.int8 else args.dtype, runtime=args.runtime)
+        prepare_batch = lambda batch: wembeddings.prepare_batch(args.model, batch)
+        compute_embeddings = lambda batch: wembeddings.compute_prepared_embeddings(args.model, batch)
 
-    # Compute word embeddings
-    with zipfile.ZipFile(args.output_npz, mode="w", compression=zipfile.ZIP_STORED) as output_npz:
-        for i in range(0, len(sentences), args.batch_size):
-            sentences_embeddings = wembeddings.compute_embeddings(args.model, sentences[i:i + args.batch_size])
-            for j, sentence_embeddings in enumerate(sentences_embeddings):
-                with output_npz.open("arr_{}".format(i + j), mode="w") as embeddings_file:
-                    np.save(embeddings_file, sentence_embeddings.astype(args.dtype))
-                if (i + j + 1) % 100 == 0:
-                    print("Processed {}/{} sentences.".format(i + j + 1, len(sentences)), file=sys.stderr, flush=True)
+    # Compute word embeddings, tokenizing the next batch and writing
+    # the previous one while the current one is being computed
+    with zipfile.ZipFile(args.output_npz, mode="w", compression=zipfile.ZIP_STORED) as output_npz, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=1) as tokenizer_pool, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=1) as writer_pool:
+        def write_embeddings(start, indices, sentences_embeddings):
+            # Serialize every array to a reused memory buffer and store it as a whole zip entry
+            embeddings_buffer = io.BytesIO()
+            for j, (index, sentence_embeddings) in enumerate(zip(indices, sentences_embeddings)):
+                embeddings_buffer.seek(0)
+                embeddings_buffer.truncate()
+                if args.dtype == np.int8:
+                    # Quantize every word embedding using its own scale, stored as `scale_{index}`
+                    sentence_embeddings = sentence_embeddings.astype(np.float32)
+                    scales = (np.max(np.abs(sentence_embeddings), axis=-1, keepdims=True) / 127).astype(np.float16)
+                    sentence_embeddings = np.clip(np.round(
+                        sentence_embeddings / np.where(scales > 0, scales, 1).astype(np.float32)), -127, 127)
+                    np.lib.format.write_array(embeddings_buffer, scales, allow_pickle=False)
+                    output_npz.writestr("scale_{}".format(index), embeddings_buffer.getvalue())
+                    embeddings_buffer.seek(0)
+                    embeddings_buffer.truncate()
+                np.lib.format.write_array(embeddings_buffer, sentence_embeddings.astype(args.dtype, copy=False), allow_pickle=False)
+                output_npz.writestr("arr_{}".format(index), embeddings_buffer.getvalue())
+                if (start + j + 1) % 100 == 0:
+                    print("Processed {}/{} sentences.".format(start + j + 1, len(sentences)), file=sys.stderr, flush=True)
+
+        # Process the sentences sorted by length to minimize padding; the
+        # embeddings are still stored under the original sentence indices
+        order = sorted(range(len(sentences)), key=lambda index: len(sentences[index]))
+        batches = [order[i:i + args.batch_size] for i in range(0, len(order), args.batch_size)]
+
+        # Bound the number of computed batches waiting to be written
+        pending_writes = queue.Queue(maxsize=2)
+
+        next_batch = tokenizer_pool.submit(prepare_batch, [sentences[index] for index in batches[0]]) if batches else None
+        for b, indices in enumerate(batches):
+            batch = next_batch.result()
+            if b + 1 < len(batches):
+                next_batch = tokenizer_pool.submit(prepare_batch, [sentences[index] for index in batches[b + 1]])
+
+            sentences_embeddings = compute_embeddings(batch)
+
+            if pending_writes.full():
+                pending_writes.get().result()
+            pending_writes.put(writer_pool.submit(write_embeddings, b * args.batch_size, indices, sentences_embeddings))
+        while not pending_writes.empty():
+            pending_writes.get().result()
     print("Done, all embeddings saved.", file=sys.stderr, flush=True)
@@ -35,6 +35,7 @@ if __name__ == "__main__":
     parser.add_argument("--dtype", default="float16", type=str, help="Dtype to serve the embeddings as")
     parser.add_argument("--logfile", default=None, type=str, help="Log path")
     parser.add_argument("--preload_models", default=[], nargs="*", type=str, help="Models to preload, or `all`")
+    parser.add_argument("--runtime", default="tf", type=str, help="Runtime to use (tf, onnx)")
     parser.add_argument("--threads", default=4, type=int, help="Threads to use")
     args = parser.parse_args()
     args.dtype = getattr(np, args.dtype)
@@ -47,7 +48,7 @@ if __name__ == "__main__":
     server = wembeddings_server.WEmbeddingsServer(
         args.port,
         args.dtype,
-        lambda: wembeddings.WEmbeddings(threads=args.threads, preload_models=args.preload_models),
+        lambda: wembeddings.WEmbeddings(threads=args.threads, preload_models=args.preload_models, dtype=args.dtype, runtime=args.runtime),
     )
     server_thread = threading.Thread(target=server.serve_forever, daemon=True)
     server_thread.start()
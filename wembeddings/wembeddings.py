@@ -10,7 +10,10 @@
 
 """Word embeddings computation class."""
 
+import itertools
 import json
+import os
+import struct
 import sys
 import time
 import urllib.request
@@ -18,6 +21,62 @@ import urllib.request
 import numpy as np
 
 
+def _pack_subwords_loop(words_lengths, sentences_lengths, max_subwords):
+    """Assign words to rows of at most `max_subwords` subwords.
+
+    Sentences are split into several rows when they contain too many subwords.
+    The function runs both as plain Python on lists and compiled by Numba on arrays.
+    Arguments:
+        words_lengths: number of subwords of every word of all the sentences.
+        sentences_lengths: number of words of every sentence.
+        max_subwords: maximum number of subwords in a row.
+    Returns:
+        a tuple `(words_rows, words_offsets, words_segments, rows_subwords, rows_words, sentences_rows)`
+        with the row, the first subword and the segment in the row of every word, the number
+        of subwords and words of every row, and the number of rows of every sentence.
+    """
+    words_rows, words_offsets, words_segments = [], [], []
+    rows_subwords, rows_words, sentences_rows = [], [], []
+
+    word = 0
+    for sentence_length in sentences_lengths:
+        rows_subwords.append(0)
+        rows_words.append(0)
+        sentences_rows.append(1)
+        for word_length in words_lengths[word:word + sentence_length]:
+            if rows_subwords[-1] + word_length > max_subwords:
+                rows_subwords.append(0)
+                rows_words.append(0)
+                sentences_rows[-1] += 1
+            words_rows.append(len(rows_subwords) - 1)
+            words_offsets.append(rows_subwords[-1])
+            words_segments.append(rows_words[-1])
+            rows_subwords[-1] += word_length
+            rows_words[-1] += 1
+        word += sentence_length
+
+    return (np.array(words_rows, np.int32), np.array(words_offsets, np.int32), np.array(words_segments, np.int32),
+            np.array(rows_subwords, np.int32), np.array(rows_words, np.int32), np.array(sentences_rows, np.int32))
+
+_pack_subwords_compiled = None
+
+def _pack_subwords(words_lengths, sentences_lengths, max_subwords):
+    """Run `_pack_subwords_loop` on the given arrays, compiled by Numba if it is installed."""
+    global _pack_subwords_compiled
+
+    # Numba is imported lazily, only when the packing is first needed
+    if _pack_subwords_compiled is None:
+        try:
+            import numba
+            _pack_subwords_compiled = numba.njit(cache=True)(_pack_subwords_loop)
+        except ImportError:
+            _pack_subwords_compiled = False
+
+    if _pack_subwords_compiled:
+        return _pack_subwords_compiled(words_lengths, sentences_lengths, max_subwords)
+    return _pack_subwords_loop(words_lengths.tolist(), sentences_lengths.tolist(), max_subwords)
+
+
 class WEmbeddings:
     """Class to keep multiple constructed word embedding computation models."""
 
@@ -29,14 +88,25 @@ class WEmbeddings:
 
     MAX_SUBWORDS_PER_SENTENCE = 510
 
+    # With XLA, subwords are padded to a multiple of this length, to limit the number of compilations
+    SUBWORDS_PADDING_MULTIPLE = 32
+
+    # Maximum number of tokenized words cached by every model
+    SUBWORDS_CACHE_SIZE = 200000
+
     class _Model:
         """Construct a tokenizer and transformers model graph."""
-        def __init__(self, transformers_model, layer_start, layer_end, loader_lock):
+        def __init__(self, transformers_model, layer_start, layer_end, dtype, runtime, threads, xla, loader_lock):
             self._model_loaded = False
             self._transformers_model_name = transformers_model
             self._layer_start = layer_start
             self._layer_end = layer_end
+            self._dtype = dtype
+            self._runtime = runtime
+            self._threads = threads
+            self._xla = xla
             self._loader_lock = loader_lock
+            self.subwords_cache = {}
 
         def load(self):
             if self._model_loaded: return
@@ -53,24 +123,87 @@ class WEmbeddings:
                     config=transformers.AutoConfig.from_pretrained(self._transformers_model_name, output_hidden_states=True),
                 )
 
-                def compute_embeddings(subwords, segments):
-                    _, _, subword_embeddings_layers = self._transformers_model((subwords, tf.cast(tf.not_equal(subwords, 0), tf.int32)))
-                    subword_embeddings = tf.math.reduce_mean(subword_embeddings_layers[self._layer_start:self._layer_end], axis=0)
-
-                    # Average subwords (word pieces) word embeddings for each token
-                    def average_subwords(embeddings_and_segments):
-                        subword_embeddings, segments = embeddings_and_segments
-                        return tf.math.segment_mean(subword_embeddings, segments)
-                    word_embeddings = tf.map_fn(average_subwords, (subword_embeddings[:, 1:], segments), dtype=tf.float32)[:, :-1]
-                    return word_embeddings
+                def compute_subword_embeddings(subwords, mask):
+                    _, _, subword_embeddings_layers = self._transformers_model((subwords, mask))
+                    # Average the layers in float32
+                    return tf.math.reduce_mean(
+                        tf.cast(subword_embeddings_layers[self._layer_start:self._layer_end], tf.float32), axis=0)
+
+                if self._runtime == "onnx":
+                    self.compute_embeddings = self._export_onnx(compute_subword_embeddings)
+                    # The TF model is no longer needed once exported
+                    del self._transformers_model
+                    self._model_loaded = True
+                    return
+
+                # Optionally compile the transformer with XLA; the segment averaging below
+                # has data-dependent number of segments, so it stays outside
+                if self._xla:
+                    compute_subword_embeddings = tf.function(compute_subword_embeddings, experimental_compile=True)
+
+                def compute_embeddings(subwords, mask, segments):
+                    subword_embeddings = compute_subword_embeddings(subwords, mask)
+
+                    # Average subwords (word pieces) word embeddings for each token, processing
+                    # the whole batch at once by offsetting the segments of every sentence
+                    batch_size, segments_per_sentence = tf.shape(segments)[0], tf.math.reduce_max(segments) + 1
+                    word_embeddings = tf.math.unsorted_segment_mean(
+                        tf.reshape(subword_embeddings[:, 1:], [-1, tf.shape(subword_embeddings)[-1]]),
+                        tf.reshape(segments + segments_per_sentence * tf.range(batch_size)[:, tf.newaxis], [-1]),
+                        batch_size * segments_per_sentence)
+                    word_embeddings = tf.reshape(word_embeddings, [batch_size, segments_per_sentence, -1])[:, :-1]
+
+                    # Cast to the output dtype already in the graph to reduce the copied data
+                    return tf.cast(word_embeddings, tf.as_dtype(self._dtype))
                 self.compute_embeddings = tf.function(compute_embeddings).get_concrete_function(
-                    tf.TensorSpec(shape=[None, None], dtype=tf.int32), tf.TensorSpec(shape=[None, None], dtype=tf.int32)
+                    tf.TensorSpec(shape=[None, None], dtype=tf.int32), tf.TensorSpec(shape=[None, None], dtype=tf.int32),
+                    tf.TensorSpec(shape=[None, None], dtype=tf.int32)
                 )
+                self._device = "/GPU:0" if tf.config.list_logical_devices("GPU") else "/CPU:0"
 
                 self._model_loaded = True
 
-
-    def __init__(self, max_form_len=64, threads=None, preload_models=[]):
+        def to_device(self, *arrays):
+            """Copy the given Numpy arrays to the device the model runs on."""
+            if self._runtime == "onnx":
+                return arrays
+
+            import tensorflow as tf
+            with tf.device(self._device):
+                return tuple(tf.identity(array) for array in arrays)
+
+        def _export_onnx(self, compute_subword_embeddings):
+            """Export the subword embeddings computation to ONNX and run it using ONNX Runtime."""
+            import tempfile
+
+            import onnxruntime
+            import tensorflow as tf
+            import tf2onnx
+
+            with tempfile.TemporaryDirectory() as onnx_dir:
+                onnx_path = os.path.join(onnx_dir, "model.onnx")
+                tf2onnx.convert.from_function(
+                    tf.function(compute_subword_embeddings),
+                    input_signature=[tf.TensorSpec(shape=[None, None], dtype=tf.int32, name="subwords"),
+                                     tf.TensorSpec(shape=[None, None], dtype=tf.int32, name="mask")],
+                    opset=12, output_path=onnx_path)
+
+                options = onnxruntime.SessionOptions()
+                options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+                if self._threads is not None:
+                    options.intra_op_num_threads = self._threads
+                providers = [provider for provider in ["CUDAExecutionProvider", "CPUExecutionProvider"]
+                             if provider in onnxruntime.get_available_providers()]
+                session = onnxruntime.InferenceSession(onnx_path, options, providers=providers)
+            subwords_name, mask_name = [session_input.name for session_input in session.get_inputs()]
+
+            def compute_embeddings(subwords, mask, segments):
+                subword_embeddings, = session.run(None, {subwords_name: subwords, mask_name: mask})
+                return WEmbeddings._average_subwords(subword_embeddings[:, 1:], segments).astype(self._dtype)
+            return compute_embeddings
+
+
+    def __init__(self, max_form_len=64, threads=None, preload_models=[], dtype=np.float32, runtime="tf"):
         import tensorflow as tf
         import threading
         import transformers
@@ -80,12 +213,21 @@ class WEmbeddings:
             tf.config.threading.set_inter_op_parallelism_threads(threads)
             tf.config.threading.set_intra_op_parallelism_threads(threads)
 
+        # Run the transformer either using TensorFlow (`tf`) or ONNX Runtime (`onnx`)
+        if runtime not in ["tf", "onnx"]:
+            raise ValueError("Unknown WEmbeddings runtime {}".format(runtime))
+
         self._max_form_len = max_form_len
 
+        # Compile the TF transformers models with XLA when requested by the environment;
+        # the inputs are then padded to fewer distinct shapes, each requiring a compilation
+        xla = runtime == "tf" and os.environ.get("WEMBEDDINGS_XLA", "0") == "1"
+        self._subwords_padding_multiple = self.SUBWORDS_PADDING_MULTIPLE if xla else 1
+
         loader_lock = threading.Lock()
         self._models = {}
         for model_name, (transformers_model, layer_start, layer_end) in self.MODELS_MAP.items():
-            self._models[model_name] = self._Model(transformers_model, layer_start, layer_end, loader_lock)
+            self._models[model_name] = self._Model(transformers_model, layer_start, layer_end, dtype, runtime, threads, xla, loader_lock)
 
             if model_name in preload_models or "all" in preload_models:
                 self._models[model_name].load()
@@ -96,78 +238,193 @@ class WEmbeddings:
             model: one of the keys of self.MODELS_MAP.
             sentences: 2D Python array with sentences with tokens (strings).
         Returns:
-            embeddings as a Python list of 1D Numpy arrays
+            embeddings as a Python list of 1D Numpy arrays of the `dtype`
+            given in the constructor
+        """
+
+        time_tokenization = time.time()
+        batch = self.prepare_batch(model, sentences)
+
+        time_embeddings = time.time()
+        embeddings = self.compute_prepared_embeddings(model, batch)
+
+        if sentences:
+            np_subwords, _, _, _ = batch
+            print("WEmbeddings in {:.1f}ms,".format(1000 * (time.time() - time_embeddings)),
+                  "tokenization in {:.1f}ms,".format(1000*(time_embeddings - time_tokenization)),
+                  "batch {},".format(len(sentences)),
+                  "max sentence len {},".format(max(len(sentence) for sentence in sentences)),
+                  "padded subwords {}.".format(np_subwords.shape[1]),
+                  file=sys.stderr, flush=True)
+
+        return embeddings
+
+    def prepare_batch(self, model, sentences):
+        """Tokenizes sentences and pads them to a batch for the model.
+
+        The tokenization does not use the computation graph, so it can run
+        in a different thread than `compute_prepared_embeddings`.
+
+        Arguments:
+            model: one of the keys of self.MODELS_MAP.
+            sentences: 2D Python array with sentences with tokens (strings).
+        Returns:
+            a tuple `(np_subwords, np_mask, np_segments, parts)` to be passed
+            to `compute_prepared_embeddings`
         """
 
         if model not in self._models:
             print("No such WEmbeddings model {}".format(model), file=sys.stderr, flush=True)
 
+        if not sentences:
+            return None, None, None, []
+
+        model = self._models[model]
+        model.load()
+
+        # Tokenize all words of the batch not yet in the cache in a single tokenizer
+        # call, truncating every word to at most `max_form_len` subwords in the tokenizer itself
+        words = [word for sentence in sentences for word in sentence]
+        missing_words = list(dict.fromkeys(word for word in words if word not in model.subwords_cache))
+        if len(model.subwords_cache) + len(missing_words) > self.SUBWORDS_CACHE_SIZE:
+            model.subwords_cache.clear()
+            missing_words = list(dict.fromkeys(words))
+        missing_subwords = dict(zip(missing_words, model.tokenizer.batch_encode_plus(
+            missing_words, add_special_tokens=False, max_length=self._max_form_len)["input_ids"])) if missing_words else {}
+        words_subwords = [model.subwords_cache[word] if word in model.subwords_cache else missing_subwords[word] for word in words]
+        model.subwords_cache.update(itertools.islice(
+            missing_subwords.items(), max(self.SUBWORDS_CACHE_SIZE - len(model.subwords_cache), 0)))
+
+        # Assign words to rows, splitting sentences with too many subwords
+        words_lengths = np.array([len(word_subwords) for word_subwords in words_subwords], np.int32)
+        words_rows, words_offsets, words_segments, rows_subwords, rows_words, sentences_rows = _pack_subwords(
+            words_lengths,
+            np.array([len(sentence) for sentence in sentences], np.int32),
+            self.MAX_SUBWORDS_PER_SENTENCE)
+        parts = [sentence_parts.tolist() for sentence_parts in np.split(rows_words, np.cumsum(sentences_rows)[:-1])]
+
+        max_sentence_len = max(len(sentence) for sentence in sentences)
+        max_subwords = rows_subwords.max() + 2
+        max_subwords = -(-max_subwords // self._subwords_padding_multiple) * self._subwords_padding_multiple
+
+        # Surround the subwords of every row by the special tokens
+        special_prefix, special_suffix = model.tokenizer.build_inputs_with_special_tokens([])
+        np_subwords = np.zeros([len(rows_subwords), max_subwords], np.int32)
+        np_subwords[:, 0] = special_prefix
+        np_subwords[np.arange(len(rows_subwords)), rows_subwords + 1] = special_suffix
+
+        # Scatter all the subwords and their segments at once
+        total_subwords = words_lengths.sum()
+        subwords_rows = np.repeat(words_rows, words_lengths)
+        subwords_columns = np.arange(total_subwords) + np.repeat(words_offsets - (np.cumsum(words_lengths) - words_lengths), words_lengths)
+        np_subwords[subwords_rows, 1 + subwords_columns] = np.fromiter(
+            itertools.chain.from_iterable(words_subwords), np.int32, count=total_subwords)
+
+        np_segments = np.full([len(rows_subwords), max_subwords - 1], max_sentence_len, np.int32)
+        np_segments[subwords_rows, subwords_columns] = np.repeat(words_segments, words_lengths)
+
+        # Attention mask of the nonzero subwords, as it was computed in the graph before
+        np_mask = (np_subwords != 0).astype(np.int32)
+
+        # Copy the inputs to the device already here, so that the copy can overlap with a computation
+        np_subwords, np_mask, np_segments = model.to_device(np_subwords, np_mask, np_segments)
+
+        return np_subwords, np_mask, np_segments, parts
+
+    def compute_prepared_embeddings(self, model, batch):
+        """Computes word embeddings of a batch returned by `prepare_batch`.
+        Arguments:
+            model: one of the keys of self.MODELS_MAP.
+            batch: the result of `prepare_batch` for the same model.
+        Returns:
+            embeddings as a Python list of 1D Numpy arrays
+        """
+
+        np_subwords, np_mask, np_segments, parts = batch
+
         embeddings = []
-        if sentences:
+        if parts:
             model = self._models[model]
             model.load()
 
-            time_tokenization = time.time()
-
-            subwords, segments, parts = [], [], []
-            for i, sentence in enumerate(sentences):
-                segments.append([])
-                subwords.append([])
-                parts.append([0])
-                for word in sentence:
-                    word_subwords = model.tokenizer.encode(word[:self._max_form_len], add_special_tokens=False)
-                    # Split sentences with too many subwords
-                    if len(subwords[-1]) + len(word_subwords) > self.MAX_SUBWORDS_PER_SENTENCE:
-                        subwords[-1] = model.tokenizer.build_inputs_with_special_tokens(subwords[-1])
-                        segments.append([])
-                        subwords.append([])
-                        parts[-1].append(0)
-                    segments[-1].extend([parts[-1][-1]] * len(word_subwords))
-                    subwords[-1].extend(word_subwords)
-                    parts[-1][-1] += 1
-                subwords[-1] = model.tokenizer.build_inputs_with_special_tokens(subwords[-1])
-
-            max_sentence_len = max(len(sentence) for sentence in sentences)
-            max_subwords = max(len(sentence) for sentence in subwords)
-
-            time_embeddings = time.time()
-            np_subwords = np.zeros([len(subwords), max_subwords], np.int32)
-            for i, subword in enumerate(subwords):
-                np_subwords[i, :len(subword)] = subword
-
-            np_segments = np.full([len(segments), max_subwords - 1], max_sentence_len, np.int32)
-            for i, segment in enumerate(segments):
-                np_segments[i, :len(segment)] = segment
-
-            embeddings_with_parts = model.compute_embeddings(np_subwords, np_segments).numpy()
-
-            # Concatenate splitted sentences
+            embeddings_with_parts = np.asarray(model.compute_embeddings(np_subwords, np_mask, np_segments))
+
+            # Concatenate splitted sentences; unsplitted ones are returned as views
             current_sentence_part = 0
             for sentence_parts in parts:
-                embeddings.append(np.concatenate(
-                    [embeddings_with_parts[current_sentence_part + i, :sentence_part] for i, sentence_part in enumerate(sentence_parts)],
-                    axis=0))
+                if len(sentence_parts) == 1:
+                    embeddings.append(embeddings_with_parts[current_sentence_part, :sentence_parts[0]])
+                else:
+                    embeddings.append(np.empty([sum(sentence_parts), embeddings_with_parts.shape[-1]], embeddings_with_parts.dtype))
+                    offset = 0
+                    for i, sentence_part in enumerate(sentence_parts):
+                        embeddings[-1][offset:offset + sentence_part] = embeddings_with_parts[current_sentence_part + i, :sentence_part]
+                        offset += sentence_part
                 current_sentence_part += len(sentence_parts)
 
-            print("WEmbeddings in {:.1f}ms,".format(1000 * (time.time() - time_embeddings)),
-                  "tokenization in {:.1f}ms,".format(1000*(time_embeddings - time_tokenization)),
-                  "batch {},".format(len(sentences)),
-                  "max sentence len {},".format(max_sentence_len),
-                  "max subwords {}.".format(max_subwords),
-                  file=sys.stderr, flush=True)
-
         return embeddings
 
 
+    @staticmethod
+    def _average_subwords(subword_embeddings, segments):
+        """Average subword embeddings of every segment in Numpy, dropping the last (padding) segment.
+
+        The segments are nondecreasing in every sentence, so after offsetting them by
+        the sentence index they are sorted and every segment is a contiguous range.
+        """
+        batch_size, segments_per_sentence = segments.shape[0], segments.max() + 1
+        flat_segments = (segments + segments_per_sentence * np.arange(batch_size)[:, np.newaxis]).reshape(-1)
+
+        starts = np.flatnonzero(np.diff(flat_segments, prepend=-1))
+        sums = np.add.reduceat(subword_embeddings.reshape([-1, subword_embeddings.shape[-1]]), starts, axis=0)
+        counts = np.diff(np.append(starts, len(flat_segments)))
+
+        word_embeddings = np.zeros([batch_size * segments_per_sentence, subword_embeddings.shape[-1]], np.float32)
+        word_embeddings[flat_segments[starts]] = sums / counts[:, np.newaxis]
+        return word_embeddings.reshape([batch_size, segments_per_sentence, -1])[:, :-1]
+
     class ClientNetwork:
-        def __init__(self, url):
+        def __init__(self, url, raw_format=True):
+            """Construct a client of the WEmbeddings server.
+
+            If `raw_format` is set, the embeddings are requested in the raw format
+            (shape and data without the npy header); servers not supporting it
+            respond using the npy format, which is also handled.
+            """
             self._url = url
+            self._raw_format = raw_format
         def compute_embeddings(self, model, sentences):
+            request = {"model": model, "sentences": sentences}
+            if self._raw_format:
+                request["format"] = "raw"
             with urllib.request.urlopen(
                     "http://{}/wembeddings".format(self._url),
-                    data=json.dumps({"model": model, "sentences": sentences}, ensure_ascii=True).encode("ascii"),
+                    data=json.dumps(request, ensure_ascii=True).encode("ascii"),
             ) as response:
+                dtype = response.headers.get("WEmbeddings-Dtype")
                 embeddings = []
                 for _ in sentences:
-                    embeddings.append(np.lib.format.read_array(response, allow_pickle=False))
+                    if dtype is not None:
+                        rows, columns = struct.unpack("<II", response.read(8))
+                        # Read into a bytearray, so that the embeddings are writable like the npy ones
+                        embeddings.append(np.frombuffer(
+                            bytearray(response.read(rows * columns * np.dtype(dtype).itemsize)), dtype=dtype).reshape([rows, columns]))
+                    else:
+                        embeddings.append(np.lib.format.read_array(response, allow_pickle=False))
                 return embeddings
+
+        @staticmethod
+        def load_npz(path):
+            """Loads word embeddings stored by `compute_wembeddings.py`.
+
+            Embeddings quantized to int8 are multiplied back by their scales.
+            Returns:
+                embeddings as a Python list of 1D Numpy arrays
+            """
+            embeddings = []
+            with np.load(path) as npz:
+                for i in range(sum(name.startswith("arr_") for name in npz.files)):
+                    embeddings.append(npz["arr_{}".format(i)])
+                    if "scale_{}".format(i) in npz:
+                        embeddings[-1] = embeddings[-1].astype(np.float32) * npz["scale_{}".format(i)].astype(np.float32)
+            return embeddings
@@ -13,6 +13,7 @@
 import http.server
 import json
 import socketserver
+import struct
 import sys
 import threading
 import urllib.parse
@@ -24,12 +25,14 @@ class WEmbeddingsServer(socketserver.ThreadingTCPServer):
     class WEmbeddingsRequestHandler(http.server.BaseHTTPRequestHandler):
         protocol_version = "HTTP/1.1"
 
-        def respond(request, content_type, code=200):
+        def respond(request, content_type, code=200, headers={}):
             request.close_connection = True
             request.send_response(code)
             request.send_header("Connection", "close")
             request.send_header("Content-Type", content_type)
             request.send_header("Access-Control-Allow-Origin", "*")
+            for header, value in headers.items():
+                request.send_header(header, value)
             request.end_headers()
 
         def respond_error(request, message, code=400):
@@ -55,6 +58,8 @@ class WEmbeddingsServer(socketserver.ThreadingTCPServer):
                     length = int(request.headers["Content-Length"])
                     data = json.loads(request.rfile.read(length))
                     model, sentences = data["model"], data["sentences"]
+                    output_format = data.get("format", "npy")
+                    assert output_format in ["npy", "raw"]
                 except:
                     import traceback
                     traceback.print_exc(file=sys.stderr)
@@ -70,9 +75,18 @@ class WEmbeddingsServer(socketserver.ThreadingTCPServer):
                     sys.stderr.flush()
                     return request.respond_error("An error occurred during wembeddings computation.")
 
-                request.respond("application/octet_stream")
-                for sentence_embedding in sentences_embeddings:
-                    np.lib.format.write_array(request.wfile, sentence_embedding.astype(request.server._dtype), allow_pickle=False)
+                if output_format == "raw":
+                    # Every embedding is sent as its shape (two little-endian uint32) followed by
+                    # its C-ordered data; the dtype is the same for all and sent in a header
+                    request.respond("application/octet_stream", headers={"WEmbeddings-Dtype": np.dtype(request.server._dtype).str})
+                    for sentence_embedding in sentences_embeddings:
+                        sentence_embedding = np.ascontiguousarray(sentence_embedding, dtype=request.server._dtype)
+                        request.wfile.write(struct.pack("<II", *sentence_embedding.shape))
+                        request.wfile.write(sentence_embedding.data)
+                else:
+                    request.respond("application/octet_stream")
+                    for sentence_embedding in sentences_embeddings:
+                        np.lib.format.write_array(request.wfile, sentence_embedding.astype(request.server._dtype, copy=False), allow_pickle=False)
 
             # URL not found
             else: